@@ -1,3 +1,4 @@
+import itertools
 import os
 import pickle
 from typing import Union, Callable, Tuple, Optional
@@ -127,16 +128,26 @@ def cheating_astrometry_with_plots(image_recipe: Callable[[], Tuple[np.ndarray,
     return result
 
 
+def _call_job(job: Tuple[Callable, tuple]):
+    """unpack (function, args) so differing jobs can share one imap call"""
+    function, args = job
+    return function(*args)
+
+
 def main():
     download()
     normal_config = Config.instance()
 
+    # build the smoothing kernel once and reuse the same read-only array for all configs
+    gauss_kernel = util.make_gauss_kernel()
+    gauss_kernel.setflags(write=False)
+
     gauss_config = Config()
-    gauss_config.smoothing = util.make_gauss_kernel()
+    gauss_config.smoothing = gauss_kernel
     gauss_config.output_folder = 'output_files_gaussian_smooth'
 
     init_guess_config = Config()
-    init_guess_config.smoothing = util.make_gauss_kernel()
+    init_guess_config.smoothing = gauss_kernel
     init_guess_config.output_folder = 'output_files_initial_guess'
     init_guess_config.use_catalogue_positions = True
     init_guess_config.photometry_iterations = 1  # with known positions we know all stars on first iter
@@ -145,7 +156,7 @@ def main():
     cheating_config.output_folder = 'output_cheating_astrometry'
 
     lowpass_config = Config()
-    lowpass_config.smoothing = util.make_gauss_kernel()
+    lowpass_config.smoothing = gauss_kernel
     lowpass_config.output_folder = 'output_files_lowpass'
     lowpass_config.use_catalogue_positions = True
     lowpass_config.photometry_iterations = 1  # with known positions we know all stars on first iter
@@ -188,20 +199,19 @@ def main():
     #from .util import DebugPool
     #with DebugPool() as pool:
     with mp.Pool(n_threads) as pool:
-        # call photometry_full(*args[0]), photometry_full(*args[1]) ...
-        futures = []
-        results = []
-        futures.append(pool.starmap_async(photometry_with_plots, misc_args))
-        futures.append(pool.starmap_async(cheating_astrometry_with_plots, cheat_args))
-        futures.append(pool.starmap_async(photometry_with_plots, lowpass_args))
-        for future in futures:
-            results += future.get()
+        # call photometry_with_plots(*args[0]), photometry_with_plots(*args[1]) ...
+        # keep results in job order, failed jobs only return a traceback so the index is all that identifies them
+        jobs = itertools.chain(((photometry_with_plots, args) for args in misc_args),
+                               ((cheating_astrometry_with_plots, args) for args in cheat_args),
+                               ((photometry_with_plots, args) for args in lowpass_args))
+        results = list(pool.imap(_call_job, jobs, chunksize=2))
 
     results += photometry_multi(recipe_template, 'mag18-24_grid', n_images=10, config=lowpass_config, threads=n_threads)
 
     # this is not going to scale very well
+    # protocol 5+ still writes the arrays in-band, but straight from their buffers without a tobytes() copy first
     with open('../all_photometry_results.pickle', 'wb') as f:
-        pickle.dump(results, f)
+        pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
     plt.close('all')
     pass
 
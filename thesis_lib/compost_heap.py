@@ -3,19 +3,45 @@
 
 from scipy.spatial import cKDTree
 from astropy.table import Table, Row
+import numba
 import numpy as np
 from typing import List
 import pyckles
 
 
+# not parallel, this runs inside the benchmark's process pools already
+@numba.njit(cache=True)
+def _nearest_neighbour_dist(xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """brute force O(N^2) distance to the closest other point, beats building a cKDTree for small N"""
+    n = xs.size
+    out = np.empty(n)
+    for i in range(n):
+        min_dist_sq = np.inf
+        xi, yi = xs[i], ys[i]
+        for j in range(n):
+            if i != j:
+                dist_sq = (xs[j] - xi)**2 + (ys[j] - yi)**2
+                if dist_sq < min_dist_sq:
+                    min_dist_sq = dist_sq
+        out[i] = np.sqrt(min_dist_sq)
+    return out
+
+
+# below this many stars the brute force search is faster than the cKDTree, measured crossover is ~500
+# single-threaded (100 stars: 15us vs 96us, 1000 stars: 0.96ms vs 0.77ms)
+_brute_force_max_stars = 500
+
+
 def cut_close_stars(peak_table: Table, cutoff_dist: float) -> Table:
-    peak_table['nearest'] = 0.
-    x_y = np.array((peak_table['x'], peak_table['y'])).T
-    lookup_tree = cKDTree(x_y)
-    for row in peak_table:
+    if len(peak_table) < _brute_force_max_stars:
+        peak_table['nearest'] = _nearest_neighbour_dist(np.asarray(peak_table['x'], dtype=np.float64),
+                                                        np.asarray(peak_table['y'], dtype=np.float64))
+    else:
+        x_y = np.column_stack((peak_table['x'], peak_table['y']))
+        lookup_tree = cKDTree(x_y)
         # find the second nearest neighbour, first one will be the star itself...
-        dist, _ = lookup_tree.query((row['x'], row['y']), k=[2])
-        row['nearest'] = dist[0]
+        dists, _ = lookup_tree.query(x_y, k=2)
+        peak_table['nearest'] = dists[:, 1]
 
     peak_table = peak_table[peak_table['nearest'] > cutoff_dist]
     return peak_table
@@ -1,5 +1,8 @@
 from typing import Tuple, Union, Optional
 from collections import namedtuple
+import itertools
+import multiprocess as mp  # not multiprocessing, this can pickle lambdas
+import numba
 import numpy as np
 
 import astropy
@@ -8,6 +11,7 @@ from astropy.nddata import NDData
 from astropy.stats import sigma_clipped_stats, gaussian_sigma_to_fwhm
 from astropy.table import Table
 from image_registration.fft_tools import upsample_image
+from scipy.optimize import least_squares
 
 import photutils
 from photutils import EPSFBuilder
@@ -21,6 +25,13 @@ from .config import Config
 from .util import flux_to_magnitude
 config = Config.instance()
 
+# DBSCANGroup uses spatial indexing instead of DAOGroup's O(N^2) search, but needs scikit-learn
+try:
+    import sklearn  # noqa: F401 only checks that scikit-learn is available for DBSCANGroup
+    from photutils.psf import DBSCANGroup as _StarGrouper
+except ImportError:
+    _StarGrouper = DAOGroup
+
 
 PhotometryResult = namedtuple('PhotometryResult',
                               ('image', 'input_table', 'result_table', 'epsf', 'star_guesses', 'config', 'image_name'))
@@ -42,7 +53,7 @@ def do_photometry_basic(image: np.ndarray, σ_psf: float) -> Tuple[Table, np.nda
                               fwhm=σ_psf * gaussian_sigma_to_fwhm,
                               minsep_fwhm=2, roundhi=5.0, roundlo=-5.0,
                               sharplo=0.0, sharphi=2.0)
-    daogroup = DAOGroup(0.1 * σ_psf * gaussian_sigma_to_fwhm)
+    grouper = _StarGrouper(0.1 * σ_psf * gaussian_sigma_to_fwhm)
 
     mmm_bkg = MMMBackground()
 
@@ -52,11 +63,11 @@ def do_photometry_basic(image: np.ndarray, σ_psf: float) -> Tuple[Table, np.nda
     # psf_model = AiryDisk2D(radius = airy_minimum)#prepare_psf_model(AiryDisk2D,xname ="x_0",yname="y_0")
     # psf_model = Moffat2D([amplitude, x_0, y_0, gamma, alpha])
 
-    # photometry = IterativelySubtractedPSFPhotometry(finder=iraffind, group_maker=daogroup,
+    # photometry = IterativelySubtractedPSFPhotometry(finder=iraffind, group_maker=grouper,
     #                                                bkg_estimator=mmm_bkg, psf_model=psf_model,
     #                                                fitter=LevMarLSQFitter(),
     #                                                niters=2, fitshape=(11,11))
-    photometry = BasicPSFPhotometry(finder=iraffind, group_maker=daogroup,
+    photometry = BasicPSFPhotometry(finder=iraffind, group_maker=grouper,
                                     bkg_estimator=mmm_bkg, psf_model=psf_model,
                                     fitter=LevMarLSQFitter(), aperture_radius=11.0,
                                     fitshape=(11, 11))
@@ -79,36 +90,44 @@ def cut_edges(peak_table: Table, cutout_size: int, image_size: int) -> Table:
     :return:
     """
     half = cutout_size / 2
-    x = peak_table['x']
-    y = peak_table['y']
-    mask = ((x > half) & (x < (image_size - half)) & (y > half) & (y < (image_size - half)))
+    upper = image_size - half
+    # compare on plain arrays, avoids going through Column for every operation
+    x = np.asarray(peak_table['x'])
+    y = np.asarray(peak_table['y'])
+    mask = (x > half) & (x < upper) & (y > half) & (y < upper)
     return peak_table[mask]
 
 
+# cached so every new worker process doesn't pay for the compilation again
+@numba.njit(fastmath=True, cache=True)
+def _symmetric_gauss_residual(params: np.ndarray, x: np.ndarray, y: np.ndarray, data: np.ndarray) -> np.ndarray:
+    """residual of a symmetric 2D gaussian (amplitude, x_mean, y_mean, stddev) on flattened coordinates"""
+    a, x0, y0, sigma = params[0], params[1], params[2], params[3]
+    return a * np.exp(-((x - x0)**2 + (y - y0)**2) / (2 * sigma * sigma)) - data
+
+
 def estimate_fwhm(psf: photutils.psf.EPSFModel) -> float:
     """
     Use a 2D symmetric gaussian fit to estimate the FWHM of an empirical psf
     :param psf: psfmodel to estimate
     :return: FWHM in pixel coordinates, takes into account oversampling parameter of EPSF
     """
-    from astropy.modeling import fitting
-    from astropy.modeling.functional_models import Gaussian2D
-
     # Not sure if this would work for non-quadratic images
     assert (psf.data.shape[0] == psf.data.shape[1])
     assert (psf.oversampling[0] == psf.oversampling[1])
     dim = psf.data.shape[0]
     center = int(dim / 2)
-    gauss_in = Gaussian2D(x_mean=center, y_mean=center, x_stddev=5, y_stddev=5)
-
-    # force a symmetric gaussian
-    gauss_in.y_stddev.tied = lambda model: model.x_stddev
 
     x, y = np.mgrid[:dim, :dim]
-    gauss_out = fitting.LevMarLSQFitter()(gauss_in, x, y, psf.data)
+    x = x.ravel().astype(np.float64)
+    y = y.ravel().astype(np.float64)
+    data = np.ascontiguousarray(psf.data, dtype=np.float64).ravel()
+
+    fit = least_squares(_symmetric_gauss_residual, np.array([1., center, center, 5.]),
+                        args=(x, y, data), method='lm')
 
     # have to divide by oversampling to get back to original scale
-    return gauss_out.x_fwhm / psf.oversampling[0]
+    return np.abs(fit.x[3]) * gaussian_sigma_to_fwhm / psf.oversampling[0]
 
 
 def make_stars_guess(image: np.ndarray,
@@ -154,12 +173,19 @@ def get_finder(image:np.ndarray, config: Config)-> photutils.StarFinderBase:
     return finder
 
 
+def _upsample_star(data: np.ndarray, oversampling: int, xshift: float, yshift: float) -> np.ndarray:
+    """normalize a star cutout and scale/shift it with a FFT, aligning the cutouts more precisely"""
+    return upsample_image(data/data.max(), upsample_factor=oversampling, xshift=xshift, yshift=yshift).real
+
+
 def make_epsf_combine(stars: photutils.psf.EPSFStars,
-                      oversampling: int = config.oversampling) -> photutils.psf.EPSFModel:
+                      oversampling: int = config.oversampling,
+                      threads: Optional[int] = None) -> photutils.psf.EPSFModel:
     """
     Alternative way of deriving an EPSF. Use median after resampling/scaling to just overlay images
     :param stars: candidate stars as EPSFStars
     :param oversampling: How much to scale
+    :param threads: if given, upsample the stars in a process pool of this size
     :return: epsf model
     """
     # TODO to make this more useful
@@ -169,12 +195,24 @@ def make_epsf_combine(stars: photutils.psf.EPSFStars,
 
     avg_center = np.mean([np.array(st.cutout_center) for st in stars], axis=0)
 
-    # upsample_image should scale and shift/resample an image with a FFT, aligning the cutouts more precisely
-    combined = np.median([upsample_image(star.data/star.data.max(), upsample_factor=oversampling,
-                                         xshift=star.cutout_center[0] - avg_center[0],
-                                         yshift=star.cutout_center[1] - avg_center[1]
-                                         ).real
-                          for star in stars], axis=0)
+    upsample_args = [(star.data, oversampling,
+                      star.cutout_center[0] - avg_center[0],
+                      star.cutout_center[1] - avg_center[1])
+                     for star in stars]
+    # every cutout is resampled independently, so this can be farmed out
+    if threads:
+        with mp.Pool(threads) as pool:
+            upsampled = pool.starmap(_upsample_star, upsample_args)
+    else:
+        upsampled = itertools.starmap(_upsample_star, upsample_args)
+
+    # fill a preallocated contiguous stack instead of a list that np.median has to copy again
+    height, width = stars[0].data.shape
+    combined_stack = np.empty((len(stars), height * oversampling, width * oversampling), dtype=np.float32)
+    for i, star_upsampled in enumerate(upsampled):
+        combined_stack[i] = star_upsampled
+    # the stack is scratch space, let median partition it in place instead of copying it first
+    combined = np.median(combined_stack, axis=0, overwrite_input=True)
 
     combined-=np.min(combined)
     combined/=np.max(combined)
@@ -225,17 +263,15 @@ def do_photometry_epsf(image: np.ndarray,
     """
 
     separation_factor = config.separation_factor
-    clip_sigma = config.clip_sigma
     photometry_iterations = config.photometry_iterations
 
     epsf = photutils.psf.prepare_psf_model(epsf, renormalize_psf=False)  # renormalize is super slow...
 
     background_rms = MADStdBackgroundRMS()
 
-    _, img_median, img_stddev = sigma_clipped_stats(image, sigma=clip_sigma)
     fwhm_guess = estimate_fwhm(epsf.psfmodel)
 
-    grouper = DAOGroup(separation_factor * fwhm_guess)
+    grouper = _StarGrouper(separation_factor * fwhm_guess)
 
     epsf.fwhm = astropy.modeling.Parameter('fwhm', 'this is not the way to add this I think')
     epsf.fwhm.value = fwhm_guess
@@ -323,11 +359,15 @@ def run_photometry(image: np.ndarray,
 
     print(f'starting job on image {filename} with {config}')
 
-    finder = get_finder(image, config)
+    # single precision is plenty for the fits at these SNRs and halves memory traffic of everything downstream.
+    # The result still holds the original image
+    image_f32 = image.astype(np.float32, copy=False)
+
+    finder = get_finder(image_f32, config)
 
     # TODO should this also be done using the catalogue positions?
     # TODO can we somehow sort the stars according to usefulness?
-    star_guesses = make_stars_guess(image, finder, cutout_size=config.cutout_size)[:config.stars_to_keep]
+    star_guesses = make_stars_guess(image_f32, finder, cutout_size=config.cutout_size)[:config.stars_to_keep]
 
     if len(star_guesses) < config.stars_to_keep:
         print('Warning: found less stars than config.stars_to_keep')
@@ -340,14 +380,14 @@ def run_photometry(image: np.ndarray,
 
     if config.use_catalogue_positions:
         guess_table = input_table.copy()
-        guess_table = cut_edges(guess_table, config.cutout_size, image.shape[0])
+        guess_table = cut_edges(guess_table, config.cutout_size, image_f32.shape[0])
         guess_table.rename_columns(['x', 'y'], ['x_0', 'y_0'])
         guess_table['x_0'] += np.random.uniform(-0.2, +0.2, size=len(guess_table['x_0']))
         guess_table['y_0'] += np.random.uniform(-0.2, +0.2, size=len(guess_table['y_0']))
     else:
         guess_table = None
 
-    result_table = do_photometry_epsf(image, epsf, finder, initial_guess=guess_table, config=config)
+    result_table = do_photometry_epsf(image_f32, epsf, finder, initial_guess=guess_table, config=config)
     result_table['m'] = flux_to_magnitude(result_table['flux_fit'])
 
     return PhotometryResult(image, input_table, result_table, epsf, star_guesses, config, filename)
\ No newline at end of file
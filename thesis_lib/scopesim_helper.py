@@ -1,7 +1,9 @@
+import hashlib
 import multiprocessing
 import os
 import tempfile
-from typing import Callable, Tuple, Optional
+from functools import lru_cache
+from typing import Callable, Tuple, Optional, Dict
 
 import anisocado
 import numpy as np
@@ -23,31 +25,71 @@ filter_name = 'MICADO/filters/TC_filter_K-cont.dat'
 
 # generators should be able to run in parallel but scopesim tends to lock up on the initialization
 scopesim_lock = multiprocessing.Lock()
+# constructing the optical train parses all the instrument files, only do it once per process
+_micado_cache: Optional[scopesim.OpticalTrain] = None
+# custom psf currently plugged into _micado_cache
+_micado_psf_effect: Optional[scopesim.effects.Effect] = None
+
+
+# plain float versions of the above for the unit-free conversions
+_pixel_scale_value = pixel_scale.to_value(u.arcsec/u.pixel)
+_half_max_pixel_value = max_pixel_coord.to_value(u.pixel) / 2
+
+
+def to_pixel_scale_fast(as_coord: np.ndarray) -> np.ndarray:
+    """
+    convert position of objects from arcseconds to pixel coordinates, without going through astropy units
+    """
+    return np.asarray(as_coord, dtype=np.float64) / _pixel_scale_value + _half_max_pixel_value
+
+
+def pixel_to_mas_fast(px_coord: np.ndarray) -> np.ndarray:
+    """
+    convert position of objects from pixel coordinates to arcseconds, without going through astropy units
+    """
+    # shift bounds (0,1023) to (-511.5,511.5)
+    return (np.asarray(px_coord, dtype=np.float64) - _half_max_pixel_value) * _pixel_scale_value
 
 
 def to_pixel_scale(as_coord):
     """
     convert position of objects from arcseconds to pixel coordinates
     """
-    if not isinstance(as_coord, u.Quantity):
-        as_coord *= u.arcsec
+    if isinstance(as_coord, u.Quantity):
+        as_coord = as_coord.to_value(u.arcsec)
 
-    shifted_pixel_coord = as_coord / pixel_scale
-    pixel = shifted_pixel_coord + max_pixel_coord / 2
-    return pixel.value
+    return to_pixel_scale_fast(as_coord)
 
 
 def pixel_to_mas(px_coord):
     """
     convert position of objects from pixel coordinates to arcseconds
     """
-    if not isinstance(px_coord, u.Quantity):
-        px_coord *= u.pixel
+    if isinstance(px_coord, u.Quantity):
+        px_coord = px_coord.to_value(u.pixel)
 
-    # shift bounds (0,1023) to (-511.5,511.5)
-    coord_shifted = px_coord - max_pixel_coord / 2
-    mas = coord_shifted * pixel_scale
-    return mas.value
+    return pixel_to_mas_fast(px_coord)
+
+
+# noinspection PyPep8Naming
+@lru_cache(maxsize=32)
+def _make_anisocado_psf(psf_wavelength: float, shift: Tuple[int], N: int):
+    """
+    generate the anisocado psf image and its strehl ratio, cached as this is the expensive part of make_psf
+    :return: psf image HDU, strehl ratio
+    """
+    hdus = anisocado.misc.make_simcado_psf_file(
+        [shift], [psf_wavelength], pixelSize=pixel_scale.value, N=N)
+    image = hdus[2]
+    image.data = np.squeeze(image.data)  # remove leading dimension, we're only looking at a single picture, not a stack
+
+    # noinspection PyTypeChecker
+    tmp_psf = anisocado.AnalyticalScaoPsf(N=N, wavelength=psf_wavelength)
+    return image, tmp_psf.strehl_ratio
+
+
+# psf parameters + hash of transformed psf data -> fits file already written for it
+_psf_filenames: Dict[Tuple, str] = {}
 
 
 # noinspection PyPep8Naming
@@ -62,19 +104,16 @@ def make_psf(psf_wavelength: float = 2.15,
     :param transform: function to apply to the psf array
     :return: effect object you can plug into OpticalTrain
     """
-    hdus = anisocado.misc.make_simcado_psf_file(
-        [shift], [psf_wavelength], pixelSize=pixel_scale.value, N=N)
-    image = hdus[2]
-    image.data = np.squeeze(image.data)  # remove leading dimension, we're only looking at a single picture, not a stack
+    anisocado_image, strehl = _make_anisocado_psf(psf_wavelength, tuple(shift), N)
+    image = type(anisocado_image)(data=transform(anisocado_image.data.copy()), header=anisocado_image.header.copy())
 
-    image.data = transform(image.data)
-
-    filename = tempfile.NamedTemporaryFile('w', suffix='.fits').name
-    image.writeto(filename)
-
-    # noinspection PyTypeChecker
-    tmp_psf = anisocado.AnalyticalScaoPsf(N=N, wavelength=psf_wavelength)
-    strehl = tmp_psf.strehl_ratio
+    # FieldConstantPSF only reads from files, so write each distinct psf only once
+    psf_key = (psf_wavelength, tuple(shift), N, hashlib.sha1(np.ascontiguousarray(image.data)).hexdigest())
+    filename = _psf_filenames.get(psf_key)
+    if filename is None or not os.path.exists(filename):
+        filename = tempfile.NamedTemporaryFile('w', suffix='.fits').name
+        image.writeto(filename)
+        _psf_filenames[psf_key] = filename
 
     # Todo: passing a filename that does not end in .fits causes a weird parsing error
     return scopesim.effects.FieldConstantPSF(
@@ -88,7 +127,9 @@ def make_psf(psf_wavelength: float = 2.15,
 
 def setup_optical_train(psf_effect: Optional[scopesim.effects.Effect] = None) -> scopesim.OpticalTrain:
     """
-    Create a Micado optical train with custom PSF
+    Create a Micado optical train with custom PSF.
+    The train is only constructed once per process and reused, so a previously returned train is reconfigured
+    by the next call
     :return: OpticalTrain object
     """
     if not psf_effect:
@@ -99,14 +140,23 @@ def setup_optical_train(psf_effect: Optional[scopesim.effects.Effect] = None) ->
     # #     tbl.columns[i].name = colname
     # #  UnboundLocalError: local variable 'tbl' referenced before assignment
     # mutexing this line seems to solve it...
+    global _micado_cache, _micado_psf_effect
     with scopesim_lock:
-        micado = scopesim.OpticalTrain('MICADO')
+        if _micado_cache is None:
+            _micado_cache = scopesim.OpticalTrain('MICADO')
+    micado = _micado_cache
+    # effects read !SIM/!OBS values through the global currsys, which only OpticalTrain.load sets
+    scopesim.rc.__currsys__ = micado.cmds
 
     # the previous psf had that optical element so put it in the same spot.
     # Todo This way of looking up the index is pretty stupid. Is there a better way?
     element_idx = [element.meta['name'] for element in micado.optics_manager.optical_elements].index('default_ro')
 
+    # swap out the custom psf of the previous call on the reused train
+    psf_element = micado.optics_manager.optical_elements[element_idx]
+    psf_element.effects = [effect for effect in psf_element.effects if effect is not _micado_psf_effect]
     micado.optics_manager.add_effect(psf_effect, ext=element_idx)
+    _micado_psf_effect = psf_effect
 
     # disable old psf
     # TODO - why is there no remove_effect with a similar interface?
@@ -36,12 +36,14 @@ def gauss(x, a, x0, σ):
     return a * np.exp(-(x - x0) ** 2 / (2 * σ ** 2))
 
 
+# distance to center for the 5x5 kernel grid, independent of σ so only compute it once
+_kernel_x, _kernel_y = np.meshgrid(np.linspace(-1, 1, 5), np.linspace(-1, 1, 5))
+_kernel_distances = np.sqrt(_kernel_x * _kernel_x + _kernel_y * _kernel_y)
+
+
 def make_gauss_kernel(σ=1.0):
     """create a 5x5 gaussian convolution kernel"""
-    x, y = np.meshgrid(np.linspace(-1, 1, 5), np.linspace(-1, 1, 5))
-    d = np.sqrt(x * x + y * y)
-
-    gauss_kernel = gauss(d, 1., 0.0, σ)
+    gauss_kernel = gauss(_kernel_distances, 1., 0.0, σ)
     return gauss_kernel/np.sum(gauss_kernel)
 
 
@@ -253,13 +255,13 @@ class DebugPool:
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    def map(self, function, args):
+    def map(self, function, args, chunksize=None):
         return list(map(function, args))
 
-    def imap(self, function, args):
+    def imap(self, function, args, chunksize=1):
         return map(function, args)
 
-    def imap_unordered(self, function, args):
+    def imap_unordered(self, function, args, chunksize=1):
         return self.imap(function, args)
 
     def apply_async(self, function, args):
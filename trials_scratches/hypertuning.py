@@ -1,5 +1,3 @@
-import time
-
 from thesis_lib import testdata_generators
 from thesis_lib.photometry import run_photometry
 from thesis_lib.config import Config
@@ -14,26 +12,49 @@ import matplotlib.pyplot as plt
 import multiprocess as mp
 import dill
 import os
-from collections import namedtuple
+import queue
+from functools import lru_cache
 
-result_filename = '../optimize_result_RF_lpcluster.pkl'
+result_filename = '../optimize_result_GBRT_lpcluster.pkl'
 image_name = 'gausscluster_N2000_mag22_lowpass'
 image_recipe = testdata_generators.benchmark_images[image_name]
 
 
+@lru_cache(maxsize=1)
+def _load_image(image_folder: str):
+    """read the benchmark image only once per worker process instead of on every evaluation"""
+    return testdata_generators.read_or_generate_image(image_recipe, image_name, image_folder)
+
+
+@lru_cache(maxsize=256)
+def _cached_gauss_kernel(sigma_rounded: float) -> np.ndarray:
+    """neighbouring sigma suggestions share a kernel, read-only as every config gets the same array"""
+    kernel = util.make_gauss_kernel(sigma_rounded)
+    kernel.setflags(write=False)
+    return kernel
+
+
 def objective(cutout_size: int, fitshape_half: int, sigma: float, iters: int):
+    # skopt likes to suggest the same integer points again, round sigma so near-duplicates hit the cache as well.
+    # This is the only rounding, the kernel is built from exactly this value
+    return _objective_cached(int(cutout_size), int(fitshape_half), round(float(sigma), 3), int(iters))
+
+
+# lives in each worker process, every worker builds up its own cache
+@lru_cache(maxsize=None)
+def _objective_cached(cutout_size: int, fitshape_half: int, sigma: float, iters: int):
     try:
         config = Config()
         config.use_catalogue_positions = True
         config.photometry_iterations = 1
         config.oversampling = 2
 
-        config.smoothing = util.make_gauss_kernel(sigma)
+        config.smoothing = _cached_gauss_kernel(sigma)
         config.fitshape = fitshape_half*2+1
         config.cutout_size = cutout_size
         config.epsfbuilder_iters=iters
 
-        image, input_table = testdata_generators.read_or_generate_image(image_recipe, image_name, config.image_folder)
+        image, input_table = _load_image(config.image_folder)
         result = run_photometry(image, input_table, image_name, config)
         result_table = util.match_observation_to_source(input_table, result.result_table)
 
@@ -51,60 +72,57 @@ def objective(cutout_size: int, fitshape_half: int, sigma: float, iters: int):
 
 #GaussianProcessRegressor(noise=1e-10)
 
-Job = namedtuple('Job', ('result', 'args'))
-
-
-def not_ready(job: Job):
-    return not job.result.ready()
-
 
 if __name__ == '__main__':
+    n_procs = 11
     if os.path.exists(result_filename):
         with open(result_filename, 'rb') as f:
             optimizer = dill.load(f)
     else:
+        # GBRT surrogate and sampling the acquisition function are a lot cheaper than RF/lbfgs refinement
         optimizer = Optimizer(
             dimensions=[Integer(5, 40), Integer(1, 10), Real(0.30, 3.), Categorical([4, 5, 7, 10])],
             n_jobs=12,
             random_state=1,
-            base_estimator='RF',
-            n_initial_points=14,
+            base_estimator='GBRT',
+            acq_optimizer='sampling',
+            n_initial_points=n_procs*2,
             initial_point_generator='random'
         )
 
-    n_procs = 11
+    n_evaluations = 100
     with mp.Pool(n_procs) as p:
-        jobs = []
+        # pool callbacks run in a helper thread of this process, hand finished jobs back through a queue
+        finished = queue.Queue()
+
+        def submit(args, evaluation_number):
+            print('#######')
+            print(f'Evaluation #{evaluation_number}')
+            print(args)
+            print('#######')
+            p.apply_async(objective, args,
+                          callback=lambda result: finished.put((args, result)),
+                          error_callback=lambda ex: finished.put((args, ex)))
+
         try:
-            for i in range(100):
-                args = optimizer.ask()
-                optimizer.update_next()
-                print('#######')
-                print(f'Evaluation #{i}')
-                print(args)
-                print('#######')
-                jobs.append(Job(p.apply_async(objective, args), args))
-                for job in jobs:
-                    if job.result.ready():
-                        optimizer.tell(job.args, job.result.get())
-                        jobs.remove(job)
-                while sum(map(not_ready, jobs)) >= n_procs:
-                    time.sleep(0.5)
-            for job in jobs:
-                optimizer.tell(job.args, job.result.get())
+            # fill all workers with one batch, constant liar keeps the points apart
+            n_submitted = 0
+            for args in optimizer.ask(n_points=min(n_procs, n_evaluations), strategy='cl_min'):
+                submit(args, n_submitted)
+                n_submitted += 1
+
+            # tell each result as soon as it's there and immediately give the free worker a new point
+            for _ in range(n_evaluations):
+                args, result = finished.get()
+                if isinstance(result, Exception):
+                    raise result
+                optimizer.tell(args, result)
+                if n_submitted < n_evaluations:
+                    submit(optimizer.ask(), n_submitted)
+                    n_submitted += 1
         except KeyboardInterrupt:
             pass
 
-    # with mp.Pool() as p:
-    #     try:
-    #         for i in range(30):
-    #             args = optimizer.ask(n_points=12)
-    #             result = p.starmap(objective, args)
-    #             optimizer.tell(args, result)
-    #     except KeyboardInterrupt:
-    #         pass
-
-
     res = optimizer.get_result()
 
     with open(result_filename, 'wb') as f: